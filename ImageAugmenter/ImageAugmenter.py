@@ -1,6 +1,10 @@
 import logging
+import os
 import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
+import qt
 import slicer
 from slicer.i18n import tr as _
 from slicer.i18n import translate
@@ -8,8 +12,6 @@ from slicer.ScriptedLoadableModule import *
 from slicer.util import VTKObservationMixin
 from slicer.util import setDataProbeVisible
 
-import SimpleITK as sitk
-
 class ImageAugmenter(ScriptedLoadableModule):
     """Uses ScriptedLoadableModule base class, available at:
     https://github.com/Slicer/Slicer/blob/main/Base/Python/slicer/ScriptedLoadableModule.py
@@ -24,6 +26,10 @@ class ImageAugmenter(ScriptedLoadableModule):
         self.parent.helpText = _("""MONAI and PyTorch based medical image augmentation tool. It's designed to operate on a dataset of medical images and apply a series of specific transformations to each image. This process augments the original dataset, providing a greater variety of samples for training deep learning models.""")
 
 
+# placeholder of the device list, replaced by the available GPUs when selected
+CUDA_DETECT_ITEM = "CUDA (detect...)"
+
+
 class ImageAugmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
     def __init__(self, parent=None) -> None:
         """Called when the user opens the module the first time and the widget is initialized."""
@@ -59,7 +65,9 @@ class ImageAugmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         uiWidget.setMRMLScene(slicer.mrmlScene)
         setDataProbeVisible(False)
         
+        # the GPUs are listed only on request, as querying them initializes CUDA
         self.ui.deviceList.addItem("CPU")
+        self.ui.deviceList.addItem(CUDA_DETECT_ITEM)
         
         self.ui.hierarchicalTreeWidget.expandItem(self.ui.hierarchicalTreeWidget.topLevelItem(0))
 
@@ -74,13 +82,31 @@ class ImageAugmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
         self.ui.applyButton.connect("clicked(bool)", self.onApplyButton)
         self.ui.previewButton.connect("clicked(bool)", self.onPreviewButton)
         self.ui.installRequirementsButton.connect("clicked(bool)", self.onInstallRequirements)
+        self.ui.deviceList.connect("currentIndexChanged(int)", self.onDeviceChanged)
+
+    def onDeviceChanged(self, index: int) -> None:
+        if self.ui.deviceList.itemText(index) == CUDA_DETECT_ITEM:
+            # let the combo box close before the detection
+            qt.QTimer.singleShot(0, self.detectCudaDevices)
 
+    def detectCudaDevices(self) -> None:
+        """Replaces the placeholder of the device list with the available GPUs."""
         import torch
 
+        deviceList = self.ui.deviceList
+        deviceList.blockSignals(True)
+        deviceList.removeItem(deviceList.findText(CUDA_DETECT_ITEM))
+
         if torch.cuda.is_available():
             for i in range(torch.cuda.device_count()):
                 device_name = torch.cuda.get_device_name(i)
-                self.ui.deviceList.addItem(f"GPU {i} - {device_name}")
+                deviceList.addItem(f"GPU {i} - {device_name}")
+            deviceList.setCurrentIndex(1)
+        else:
+            deviceList.setCurrentIndex(0)
+            self.ui.infoLabel.setText("No CUDA device available, using CPU")
+
+        deviceList.blockSignals(False)
 
     # def cleanup(self) -> None:
     #     """Called when the application closes and the module widget is destroyed."""
@@ -114,7 +140,7 @@ class ImageAugmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                 self.ui.installRequirementsButton.setEnabled(False)
                 self.ui.infoLabel.setText("Installing dependencies, please wait...")
                 slicer.util.pip_install("munch")
-                slicer.util.pip_install("monai[itk]")
+                slicer.util.pip_install("monai[itk,nibabel]")
                 slicer.util.restart()
             except Exception as e:
                 raise ValueError(f"Error installing dependencies: {repr(e)}")
@@ -142,7 +168,9 @@ class ImageAugmenterWidget(ScriptedLoadableModuleWidget, VTKObservationMixin):
                                filesStructure=filesStructure,
                                progressBar=self.ui.progressBar,
                                infoLabel=self.ui.infoLabel,
-                               device=self.ui.deviceList.currentText)
+                               device=self.ui.deviceList.currentText,
+                               batchSize=self.ui.batchSize.value,
+                               cacheDecodedVolumes=self.ui.cacheDecodedVolumes.checked)
             
             self.setButtonsEnabled(True)
             self.ui.progressBar.reset()
@@ -181,10 +209,69 @@ class ImageAugmenterLogic(ScriptedLoadableModuleLogic):
     def __init__(self) -> None:
         """Called when the logic class is instantiated. Can be used for initializing member variables."""
         ScriptedLoadableModuleLogic.__init__(self)
+        # pinned host buffers, keyed by ("img" | "mask", slot, dtype), reused to download every transformed CUDA tensor, see startHostCopy
+        self._hostBuffers = {}
+        # one copy stream per CUDA device, so that the downloads overlap with the saves
+        self._copyStreams = {}
+        # writes the augmented images while the next cases are transformed
+        self._ioPool = ThreadPoolExecutor(max_workers=4)
 
     def getParameterNode(self):
         return ImageAugmenterParameterNode(super().getParameterNode())
 
+    def startHostCopy(self, tensor, bufferKey="img", slot=0):
+        """
+        Starts the copy of a transformed tensor to the host and returns (hostTensor, event).
+        CUDA tensors are downloaded on a dedicated copy stream into the pinned buffer (bufferKey, slot, dtype):
+        hostTensor is ready once event.synchronize() returns, and valid until the next copy into the same buffer.
+        Other tensors are copied right away and event is None.
+        """
+        import torch
+
+        tensor = tensor.detach()
+        if tensor.device.type != "cuda":
+            return tensor.cpu(), None
+
+        # MetaTensor -> torch.Tensor, so that the copy does not wrap the buffer with the metadata
+        if hasattr(tensor, "as_tensor"):
+            tensor = tensor.as_tensor()
+        if tensor.device not in self._copyStreams:
+            self._copyStreams[tensor.device] = torch.cuda.Stream(tensor.device)
+        # one buffer per dtype, so that the copy keeps the pixel type of the output (e.g. a random flip of an int16 volume)
+        if (bufferKey, slot, tensor.dtype) not in self._hostBuffers:
+            self._hostBuffers[(bufferKey, slot, tensor.dtype)] = torch.empty(0, dtype=tensor.dtype, pin_memory=True)
+
+        copyStream = self._copyStreams[tensor.device]
+        hostBuffer = self._hostBuffers[(bufferKey, slot, tensor.dtype)]
+        # the tensor has been produced on the current stream
+        copyStream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(copyStream):
+            hostBuffer.resize_(tensor.shape).copy_(tensor, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(copyStream)
+        tensor.record_stream(copyStream)
+
+        return hostBuffer, event
+
+    def iterHost(self, transformBatch, bufferKey="img"):
+        """
+        Yields the host copy of each output of a TransformBatch. The outputs are downloaded one by one,
+        the copy of the next output running while the current one is saved (two pinned buffers are used alternately).
+        Each yielded tensor is only valid until the next one is requested.
+        """
+        tensors = transformBatch.tensors
+        if not tensors:
+            return
+
+        nextCopy = self.startHostCopy(tensors[0], bufferKey, slot=0)
+        for i in range(len(tensors)):
+            hostTensor, event = nextCopy
+            if i + 1 < len(tensors):
+                nextCopy = self.startHostCopy(tensors[i + 1], bufferKey, slot=(i + 1) % 2)
+            if event is not None:
+                event.synchronize()
+            yield hostTensor
+
     def process(self,
                 imagesInputPath: str,
                 imgPrefix: str,
@@ -194,15 +281,24 @@ class ImageAugmenterLogic(ScriptedLoadableModuleLogic):
                 progressBar,
                 infoLabel,
                 transformations: list = [],
-                device: str = "CPU"
+                device: str = "CPU",
+                batchSize: int = 1,
+                cacheDecodedVolumes: bool = False
                 ) -> None:
-        from ImageAugmenterLib.ImageAugmenterDataset import ImageAugmenterDataset
+        """
+        batchSize: number of cases transformed together. Each batch, with all its outputs, is held in memory at once,
+        so by default the cases are transformed one at a time, as without batching.
+        cacheDecodedVolumes: keep an uncompressed copy of the decoded inputs in outputPath/.cache (requires safetensors),
+        only useful when the same dataset is augmented several times. The folder is never cleaned up automatically.
+        """
+        from ImageAugmenterLib.ImageAugmenterDataset import ImageAugmenterDataset, buildDataLoader
         from ImageAugmenterLib.ImageAugmenterTransformationParser import IMPOSSIBLE_COPY_INFO_TRANSFORM
-        from ImageAugmenterLib.ImageAugmenterUtils import collectImagesAndMasksList, getOriginalCase, save, makeDir
+        from ImageAugmenterLib.ImageAugmenterUtils import collectImagesAndMasksList, getCaseName, save, makeDir
         from ImageAugmenterLib.ImageAugmenterValidator import validateCollectedImagesAndMasks
 
 
         OUTPUT_IMG_DIR = "ImageAugmenter"
+        CACHE_DIR = ".cache"
 
         startTime = time.time()
         logging.info("Processing started")
@@ -212,47 +308,69 @@ class ImageAugmenterLogic(ScriptedLoadableModuleLogic):
                                                 maskPrefix=maskPrefix)
         
         validateCollectedImagesAndMasks(imgs, masks)
-        dataset = ImageAugmenterDataset(imgPaths=imgs, maskPaths=masks, transformations=transformations, device=device)
+        dataset = ImageAugmenterDataset(imgPaths=imgs, maskPaths=masks, transformations=transformations, device=device,
+                                        cacheDir=os.path.join(outputPath, CACHE_DIR) if cacheDecodedVolumes else None,
+                                        batchSize=batchSize)
+        
+        loader = buildDataLoader(dataset)
         
         progressBar.setMaximum(len(dataset))
 
-        for dirIdx in range(len(dataset)):
-            transformedImages, transformedMasks = dataset[dirIdx]
-            try:
-                caseName, originalCaseImg = getOriginalCase(imgs[dirIdx], filesStructure)
-                originalCaseMask = sitk.ReadImage(masks[dirIdx]) if transformedMasks else None
-
-                for i in range(len(transformedImages)):
-                    imgPack = transformedImages[i]
-                    mskPack = transformedMasks[i] if i < len(transformedMasks) else None
-
-                    transformName, img = imgPack
-                    _, msk = mskPack if mskPack else (None, None)
-
-                    currentDir = makeDir(outputPath, OUTPUT_IMG_DIR, caseName, transformName)
-
-                    imgPrefixParts = imgPrefix.split(".")
-                    maskPrefixParts = maskPrefix.split(".")
-                    copyInfo = False if transformName in IMPOSSIBLE_COPY_INFO_TRANSFORM else True
-
-                    save(img=img.detach().cpu(), path=currentDir, 
-                         filename=imgPrefixParts[0], 
-                         originalCase=originalCaseImg, 
-                         extension=imgPrefixParts[1] if len(imgPrefixParts) > 1 else "nrrd", 
-                         copyInfo=copyInfo)
-
-                    if originalCaseMask and msk != None and msk.any():
-                        save(img=msk.detach().cpu(), path=currentDir, 
-                             filename=maskPrefixParts[0], 
-                             originalCase=originalCaseMask, 
-                             extension=maskPrefixParts[1] if len(maskPrefixParts) > 1 else "nrrd", 
-                             copyInfo=copyInfo)
+        # "img.nii.gz" -> ("img", "nii.gz"), "img" -> ("img", "nrrd")
+        imgFilename, imgExtension = (imgPrefix.split(".", 1) + ["nrrd"])[:2]
+        maskFilename, maskExtension = (maskPrefix.split(".", 1) + ["nrrd"])[:2]
+        caseNames = [getCaseName(img, filesStructure) for img in imgs]
+
+        pendingWrites = []
+
+        for batchIdx, samples in enumerate(loader):
+            transformedSamples = dataset.apply_batch_transformations(samples)
+
+            # the writes of the previous batch overlapped with the transformations above,
+            # wait for them before submitting new ones to bound the memory held by the pool
+            for future in pendingWrites:
+                future.result()
+            pendingWrites = []
+
+            for sampleIdx, ((transformedImages, transformedMasks), (_, _, imgHeader, maskHeader, maskNonEmpty)) in enumerate(zip(transformedSamples, samples)):
+                dirIdx = batchIdx * dataset.batchSize + sampleIdx
+                try:
+                    caseName = caseNames[dirIdx]
+                    # the headers have been read by the dataset while loading the case
+                    originalCaseImg = imgHeader
+                    originalCaseMask = maskHeader if transformedMasks is not None else None
+                    hostMasks = self.iterHost(transformedMasks, "mask") if (originalCaseMask is not None and maskNonEmpty) else repeat(None)
+
+                    for transformName, img, msk in zip(transformedImages.names, self.iterHost(transformedImages, "img"), hostMasks):
+                        currentDir = makeDir(outputPath, OUTPUT_IMG_DIR, caseName, transformName)
+
+                        copyInfo = False if transformName in IMPOSSIBLE_COPY_INFO_TRANSFORM else True
+
+                        pendingWrites.append(save(img=img, path=currentDir, 
+                                                  filename=imgFilename, 
+                                                  originalCase=originalCaseImg, 
+                                                  extension=imgExtension, 
+                                                  copyInfo=copyInfo,
+                                                  executor=self._ioPool))
+
+                        if msk is not None:
+                            pendingWrites.append(save(img=msk, path=currentDir, 
+                                                      filename=maskFilename, 
+                                                      originalCase=originalCaseMask, 
+                                                      extension=maskExtension, 
+                                                      copyInfo=copyInfo,
+                                                      executor=self._ioPool))
                     
                     
-                progressBar.setValue(dirIdx + 1)
+                    progressBar.setValue(dirIdx + 1)
         
-            except Exception as e:
-                raise e
+                except Exception as e:
+                    raise e
+
+        for future in pendingWrites:
+            future.result()
+        # the pinned buffers are as large as the biggest output, do not keep them once the run is over
+        self._hostBuffers.clear()
 
         stopTime = time.time()
         infoLabel.setText(f"Processing completed in {stopTime-startTime:.2f} seconds")
@@ -271,9 +389,8 @@ class ImageAugmenterLogic(ScriptedLoadableModuleLogic):
         
         from ImageAugmenterLib.ImageAugmenterDataset import ImageAugmenterDataset
         from ImageAugmenterLib.ImageAugmenterTransformationParser import IMPOSSIBLE_COPY_INFO_TRANSFORM
-        from ImageAugmenterLib.ImageAugmenterUtils import collectImagesAndMasksList, getOriginalCase, showPreview, clearScene, resetViews
+        from ImageAugmenterLib.ImageAugmenterUtils import collectImagesAndMasksList, getCaseName, showPreview, clearScene, resetViews
         from ImageAugmenterLib.ImageAugmenterValidator import validateCollectedImagesAndMasks
-        import SimpleITK as sitk
         
         startTime = time.time()
         logging.info("Processing started")
@@ -290,27 +407,19 @@ class ImageAugmenterLogic(ScriptedLoadableModuleLogic):
 
         for dirIdx in range(len(dataset)):
             try:
-                transformedImages, transformedMasks = dataset[dirIdx]
-                caseName, originalCaseImg = getOriginalCase(imgs[dirIdx], filesStructure)
+                caseImg, caseMask, originalCaseImg, originalCaseMask, _ = dataset[dirIdx]
+                transformedImages, transformedMasks = dataset.apply_transformations(caseImg, caseMask)
+                caseName = getCaseName(imgs[dirIdx], filesStructure)
 
-                if transformedMasks:
-                    originalCaseMask = sitk.ReadImage(masks[dirIdx])
-                    
-                    for i in range(len(transformedImages)):
-                        imgPack = transformedImages[i]
-                        mskPack = transformedMasks[i] if i < len(transformedMasks) else None
-                        
-                        transformName, img = imgPack
-                        _, msk = mskPack
-                        
+                if transformedMasks is not None:
+                    for transformName, img, msk in zip(transformedImages.names, transformedImages.tensors, transformedMasks.tensors):
                         imgNodeName = f"{caseName}_{transformName}_img"
                         maskNodeName = f"{caseName}_{transformName}_mask"
                         copyInfo = False if transformName in IMPOSSIBLE_COPY_INFO_TRANSFORM else True
                         showPreview(img=img, originalCaseImg=originalCaseImg, originalCaseMask=originalCaseMask, mask=msk,
                                     imgNodeName=imgNodeName, maskNodeName=maskNodeName, copyInfo=copyInfo)
                 else:
-                    for imgPack in transformedImages:
-                        transformName, img = imgPack
+                    for transformName, img in zip(transformedImages.names, transformedImages.tensors):
                         imgNodeName = f"{caseName}_{transformName}_img"
                         copyInfo = False if transformName in IMPOSSIBLE_COPY_INFO_TRANSFORM else True
                         showPreview(img, originalCaseImg, imgNodeName=imgNodeName, copyInfo=copyInfo)
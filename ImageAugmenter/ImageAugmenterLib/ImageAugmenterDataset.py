@@ -1,11 +1,50 @@
-from ImageAugmenterLib.ImageAugmenterUtils import sanitizeTransformName, extract_device_number
+from ImageAugmenterLib.ImageAugmenterUtils import sanitizeTransformName, extract_device_number, getImageHeader, readImageHeader
+from ImageAugmenterLib.ImageAugmenterTransformationParser import BATCHABLE_TRANSFORM, MASK_INVARIANT_TRANSFORM
+import os
+import hashlib
+import multiprocessing
+import numpy as np
 import SimpleITK as sitk
-from typing import List, Dict, Any, Optional, Tuple, Union
+from typing import List, Dict, Any, NamedTuple, Optional, Tuple, Union
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, DataLoader
 from monai.transforms import RandomizableTransform
 
+try:
+    # optional, much faster than SimpleITK to decode NIfTI volumes
+    import nibabel as nib
+except ModuleNotFoundError:
+    nib = None
+
+try:
+    # optional, used to cache the decoded volumes
+    from safetensors.torch import load_file, save_file
+except ModuleNotFoundError:
+    load_file, save_file = None, None
+
+NIFTI_EXTENSIONS = (".nii", ".nii.gz")
+
+
+def identityCollate(sample: Any) -> Any:
+    # defined at module level (instead of a lambda) so that it can be pickled by the DataLoader workers
+    return sample
+
+
+class TransformBatch(NamedTuple):
+    """
+    Outputs of the transformations applied to one case: names[i] is the name of the transformation that produced tensors[i].
+    The outputs are kept as separate tensors: stacking them would double the device memory they take,
+    and process already overlaps their downloads one by one (see ImageAugmenterLogic.iterHost).
+    """
+    names: List[str]
+    tensors: List[torch.Tensor]
+
+    @staticmethod
+    def from_list(transformedList: List[List[Any]]) -> "TransformBatch":
+        return TransformBatch([transform_name for transform_name, _ in transformedList], [tensor for _, tensor in transformedList])
+
+
 class ImageAugmenterDataset(Dataset):
     def __init__(
         self,
@@ -13,32 +52,104 @@ class ImageAugmenterDataset(Dataset):
         maskPaths: Optional[List[str]] = None,
         transformations: List[object] = [],  # Assuming MonaiTransform exists
         device: Union[str, int] = "CPU",
+        cacheDir: Optional[str] = None,
+        batchSize: int = 1,
     ):
         self.imgPaths: List[str] = imgPaths
         self.maskPaths: Optional[List[str]] = maskPaths
         self.transformations: List[object] = transformations
-        self.device: Union[str, int] = extract_device_number(device) if device.lower() != "cpu" else device.lower()
+        # resolved once, the same name is used for every case
+        self.transformNames: List[str] = [self.resolve_transform_name(transform) for transform in transformations]
+        # random transformations are applied to the image and the mask together, as a dictionary
+        self.isRandomizable: List[bool] = [isinstance(transform, RandomizableTransform) for transform in transformations]
+        # False for the intensity transformations, the original mask is reused as their output mask
+        self.operatesOnMask: List[bool] = [transform_name not in MASK_INVARIANT_TRANSFORM for transform_name in self.transformNames]
+        # parsed once, so that the tensors are not moved to a device given as a string
+        self.device: torch.device = torch.device(extract_device_number(device)) if device.lower() != "cpu" else torch.device("cpu")
+        # the decoded volumes are cached only if safetensors is installed
+        self.cacheDir: Optional[str] = cacheDir if save_file is not None else None
+        if self.cacheDir:
+            os.makedirs(self.cacheDir, exist_ok=True)
+        # number of consecutive cases transformed together by apply_batch_transformations
+        self.batchSize: int = batchSize
 
     def __len__(self) -> int:
         return len(self.imgPaths)
 
-    def load(self, path: str) -> Optional[torch.Tensor]:
+    @staticmethod
+    def decoder_name(path: str) -> str:
+        return "nibabel" if (nib is not None and path.lower().endswith(NIFTI_EXTENSIONS)) else "sitk"
+
+    def _cache_path(self, path: str) -> str:
+        # nibabel decodes to float32 while SimpleITK keeps the stored pixel type, so the decoder is part of the key
+        key = f"{self.decoder_name(path)}:{path}"
+        return os.path.join(self.cacheDir, hashlib.sha1(key.encode()).hexdigest() + ".safetensors")
+
+    def load_cached(self, path: str) -> Optional[torch.Tensor]:
+        """
+        Returns the decoded volume from the cache, or None if it is missing, older than the source file or unreadable.
+        """
+        cachePath = self._cache_path(path)
         try:
-            if (path):
-                img = sitk.ReadImage(path)
-                img_array = sitk.GetArrayFromImage(img)
-                data = torch.tensor(img_array)
-                return data
+            # the sidecar stores the mtime of the source file at the time it was cached
+            with open(f"{cachePath}.mtime") as mtimeFile:
+                if float(mtimeFile.read()) != os.path.getmtime(path):
+                    return None
+            return load_file(cachePath)["v"]
+        except Exception:
+            # e.g. a truncated or corrupted file, the volume is decoded again
             return None
+
+    def save_cached(self, path: str, data: torch.Tensor) -> None:
+        cachePath = self._cache_path(path)
+        try:
+            save_file({"v": data.contiguous()}, cachePath)
+            # written last, so that a partially written cache file is never considered valid
+            with open(f"{cachePath}.mtime", "w") as mtimeFile:
+                mtimeFile.write(repr(os.path.getmtime(path)))
+        except Exception:
+            pass
+
+    def load(self, path: str) -> Tuple[Optional[torch.Tensor], Optional[Dict[str, Any]]]:
+        """
+        Returns:
+            (data, header)  the header is the one used to copy the image information at save time, see getImageHeader
+        """
+        try:
+            if (path):
+                if self.cacheDir:
+                    data = self.load_cached(path)
+                    if data is not None:
+                        return data, readImageHeader(path)
+
+                    data, header = self.decode(path)
+                    self.save_cached(path, data)
+                    return data, header
+                return self.decode(path)
+            return None, None
         except:
-            return None
+            return None, None
+
+    def decode(self, path: str) -> Tuple[torch.Tensor, Dict[str, Any]]:
+        if self.decoder_name(path) == "nibabel":
+            # nibabel stores the voxels as (x, y, z), reverse the axes to match sitk.GetArrayFromImage (z, y, x)
+            img_array = np.asarray(nib.load(path).dataobj, dtype=np.float32).T
+            return torch.from_numpy(img_array), readImageHeader(path)
+
+        img = sitk.ReadImage(path)
+        img_array = sitk.GetArrayFromImage(img)
+        # GetArrayFromImage already returns a copy, share its buffer instead of copying it again
+        data = torch.from_numpy(np.ascontiguousarray(img_array))
+        return data, getImageHeader(img)
         
-    def apply_transform(self, transform: object, img: torch.Tensor, transformedList: List[List[Any]]) -> List[List[Any]]:
-        try:
-            transform_name = transform.get_transform_info()["class"]
-        except AttributeError:
-            # in this case get_transform_info is missing, so recover the name starting from __class__:
-            transform_name = sanitizeTransformName(transform)
+    @staticmethod
+    def resolve_transform_name(transform: object) -> str:
+        if hasattr(transform, "get_transform_info"):
+            return transform.get_transform_info()["class"]
+        # in this case get_transform_info is missing, so recover the name starting from __class__:
+        return sanitizeTransformName(transform)
+
+    def apply_transform(self, transform: object, transform_name: str, img: torch.Tensor, transformedList: List[List[Any]]) -> List[List[Any]]:
         transformedImg = transform(img.float())
         # adding ["rotate", torch.Tensor[[...]] ]
         transformedList.append([transform_name, transformedImg])
@@ -48,18 +159,12 @@ class ImageAugmenterDataset(Dataset):
     def apply_dict_transform(
         self,
         transform: object,
+        transform_name: str,
         data_dict: Dict[str, torch.Tensor],
         transformedImages: List[List[Any]],
         transformedMasks: Optional[List[List[Any]]] = None,
     ) -> List[List[Any]]:  # Generic return for flexibility        
-        try:
-            transform_name = transform.get_transform_info()["class"]
-        except AttributeError:
-            # in this case get_transform_info is missing, so recover the name starting from __class__:
-            transform_name = sanitizeTransformName(transform)
-        
-        
-        if(transformedMasks != None):
+        if(transformedMasks is not None):
             transformedImg, transformedMask = transform(data_dict).values()
             # adding ["rotate", torch.Tensor[[...]] ]
             transformedImages.append([transform_name, transformedImg])
@@ -70,36 +175,147 @@ class ImageAugmenterDataset(Dataset):
         transformedImages.append([transform_name, transformedImg["img"]])
         return transformedImages, []
 
-    def __getitem__(self, idx: int) -> Tuple[List[List[Any]], Optional[List[List[Any]]]]:
+    def __getitem__(self, idx: int) -> List[Any]:
         """
+        Only reads the data from disk, so that it can run inside the DataLoader workers.
+        The transformations are applied in the main process by apply_transformations, which owns the device.
+
         Returns:
-            transformedImgs | transformedMasks  =  [
-                ["rotate", torch.Tensor[[...]] ],
-                ["rotate", torch.Tensor[[...]] ],
-                ["flip", torch.Tensor[[...]] ],
-                ["flip", torch.Tensor[[...]] ],
-                ...
-            ]
+            [img, mask, imgHeader, maskHeader, maskNonEmpty]  (mask and maskHeader are None when no mask paths are given)
         """
-        transformedImages = []
-        transformedMasks = []
-        mask = None
-        
-        img = self.load(self.imgPaths[idx])
+        mask, maskHeader = None, None
+        maskNonEmpty = False
+
+        img, imgHeader = self.load(self.imgPaths[idx])
         if self.maskPaths is not None and len(self.maskPaths) > 0:
-            mask = self.load(self.maskPaths[idx])
-
-        for transform in self.transformations:
-            if (img != None and mask != None and isinstance(transform, RandomizableTransform)): 
-                transformedImages, transformedMasks = self.apply_dict_transform(transform, {"img": img.to(self.device), "mask": mask.to(self.device)}, transformedImages, transformedMasks)
-            
-            if (img != None and mask == None and isinstance(transform, RandomizableTransform)): 
-                transformedImages, transformedMasks = self.apply_dict_transform(transform, {"img": img.to(self.device)}, transformedImages, None)
-
-            if (img != None and not isinstance(transform, RandomizableTransform)): 
-                transformedImages = self.apply_transform(transform, img.to(self.device), transformedImages)
-           
-            if (mask != None and not isinstance(transform, RandomizableTransform)): 
-                transformedMasks = self.apply_transform(transform, mask.to(self.device), transformedMasks)
-            
+            mask, maskHeader = self.load(self.maskPaths[idx])
+            # computed once on the source mask, so that the empty masks are not saved without scanning every transformed one
+            maskNonEmpty = mask is not None and bool(mask.any())
+
+        return [img, mask, imgHeader, maskHeader, maskNonEmpty]
+
+    def apply_transformations(self, img: Optional[torch.Tensor], mask: Optional[torch.Tensor] = None) -> Tuple[TransformBatch, Optional[TransformBatch]]:
+        """
+        Returns:
+            transformedImgs | transformedMasks  =  TransformBatch(
+                names=["rotate", "flip", ...],
+                tensors=torch.Tensor[[...]]  (one output per name)
+            )
+            transformedMasks is None when there is no mask
+        """
+        return self.apply_batch_transformations([[img, mask]])[0]
+
+    def to_device(self, tensor: Optional[torch.Tensor]) -> Optional[torch.Tensor]:
+        if tensor is None or self.device.type == "cpu":
+            return tensor
+        # the DataLoader pins its outputs, so their upload is asynchronous; pinning any other tensor here
+        # (e.g. in preview) would only add a full host copy before the upload
+        if tensor.is_pinned():
+            return tensor.to(self.device, non_blocking=True)
+        return tensor.to(self.device)
+
+    @torch.inference_mode()
+    def apply_batch_transformations(self, samples: List[List[Any]]) -> List[Tuple[TransformBatch, Optional[TransformBatch]]]:
+        """
+        Applies the transformations to a batch of [img, mask, ...] samples, as returned by the DataLoader.
+        The batchable transformations run once on all the samples concatenated along the first dimension,
+        the other ones sample by sample.
+
+        Returns:
+            [(transformedImgs, transformedMasks), ...]  one pair per sample, see apply_transformations
+        """
+        # move the loaded samples to the device once, the DataLoader workers never touch it.
+        # The masks are converted to float once, so that the reused masks (see operatesOnMask) and the transformed ones
+        # are saved with the same pixel type, whatever the device
+        samples = [[self.to_device(img), self.to_device(mask).float() if mask is not None else None] for img, mask, *_ in samples]
+        results = [([], []) for _ in samples]
+
+        for transform, transform_name, isRand, operatesOnMask in zip(self.transformations, self.transformNames, self.isRandomizable, self.operatesOnMask):
+            if self.is_batchable(transform, transform_name, samples):
+                self.apply_concatenated_transform(transform, transform_name, [img for img, _ in samples], [transformedImages for transformedImages, _ in results])
+                if samples[0][1] is not None and operatesOnMask:
+                    self.apply_concatenated_transform(transform, transform_name, [mask for _, mask in samples], [transformedMasks for _, transformedMasks in results])
+                elif samples[0][1] is not None:
+                    for (_, mask), (_, transformedMasks) in zip(samples, results):
+                        transformedMasks.append([transform_name, mask])
+                continue
+
+            for sampleIdx, (img, mask) in enumerate(samples):
+                results[sampleIdx] = self.apply_sample_transform(transform, transform_name, isRand, operatesOnMask, img, mask, *results[sampleIdx])
+
+        return [(TransformBatch.from_list(transformedImages), TransformBatch.from_list(transformedMasks) if mask is not None else None)
+                for (transformedImages, transformedMasks), (_, mask) in zip(results, samples)]
+
+    def is_batchable(self, transform: object, transform_name: str, samples: List[List[Optional[torch.Tensor]]]) -> bool:
+        """
+        A transformation can run on the concatenated samples only if it acts independently on each channel
+        and all the images (and masks) can be concatenated, i.e. they differ at most in the first dimension.
+        """
+        if len(samples) < 2 or transform_name not in BATCHABLE_TRANSFORM:
+            return False
+
+        imgs = [img for img, _ in samples]
+        masks = [mask for _, mask in samples]
+
+        # the unreadable cases are skipped by the per-sample path
+        if any(img is None for img in imgs) or any(img.shape[1:] != imgs[0].shape[1:] for img in imgs):
+            return False
+        if all(mask is None for mask in masks):
+            return True
+        return all(mask is not None and mask.shape[1:] == masks[0].shape[1:] for mask in masks)
+
+    def apply_concatenated_transform(self, transform: object, transform_name: str, tensors: List[torch.Tensor], transformedLists: List[List[List[Any]]]) -> None:
+        [[_, transformed]] = self.apply_transform(transform, transform_name, torch.cat(tensors), [])
+        for transformedList, transformedTensor in zip(transformedLists, torch.split(transformed, [tensor.shape[0] for tensor in tensors])):
+            transformedList.append([transform_name, transformedTensor])
+
+    def apply_sample_transform(
+        self,
+        transform: object,
+        transform_name: str,
+        isRand: bool,
+        operatesOnMask: bool,
+        img: Optional[torch.Tensor],
+        mask: Optional[torch.Tensor],
+        transformedImages: List[List[Any]],
+        transformedMasks: Optional[List[List[Any]]],
+    ) -> Tuple[List[List[Any]], Optional[List[List[Any]]]]:
+        if img is None:
+            return transformedImages, transformedMasks
+
+        hasMask = mask is not None
+        transformMask = hasMask and operatesOnMask
+
+        if isRand and transformMask:
+            transformedImages, transformedMasks = self.apply_dict_transform(transform, transform_name, {"img": img, "mask": mask}, transformedImages, transformedMasks)
+        elif isRand:
+            transformedImages, _ = self.apply_dict_transform(transform, transform_name, {"img": img}, transformedImages, None)
+        else:
+            transformedImages = self.apply_transform(transform, transform_name, img, transformedImages)
+            if transformMask:
+                transformedMasks = self.apply_transform(transform, transform_name, mask, transformedMasks)
+
+        if hasMask and not operatesOnMask:
+            # the intensity transformations leave the labels untouched
+            transformedMasks.append([transform_name, mask])
+
         return transformedImages, transformedMasks
+
+
+def buildDataLoader(dataset: ImageAugmenterDataset) -> DataLoader:
+    """
+    Wraps the dataset in a DataLoader, so that reading the next cases from disk overlaps with
+    the transformations and the saving of the current ones.
+    Each iteration yields a list of dataset.batchSize samples, see __getitem__ and apply_batch_transformations.
+    """
+    # spawned workers start a new interpreter outside of Slicer, so the loading runs in parallel only with fork
+    startMethod = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+    numWorkers = (os.cpu_count() or 0) // 2 if startMethod == "fork" else 0
+    workersArgs = {"persistent_workers": True, "prefetch_factor": 2} if numWorkers > 0 else {}
+
+    return DataLoader(dataset,
+                      batch_size=dataset.batchSize,
+                      num_workers=numWorkers,
+                      pin_memory=(dataset.device.type != "cpu"),
+                      collate_fn=identityCollate,
+                      **workersArgs)
@@ -6,6 +6,13 @@ from typing import List
 
 DICT_KEYS = ["img", "mask"]
 IMPOSSIBLE_COPY_INFO_TRANSFORM = ["Resize", "BorderPad", "SpatialCrop", "CenterSpatialCrop"]
+# deterministic transformations acting independently on each channel, they can run on several cases concatenated along the first dimension
+# (ScaleIntensity and AdjustContrast are excluded: with the parameters set by the controllers they use the min/max or mean of the whole tensor)
+BATCHABLE_TRANSFORM = ["Rotate", "Flip", "Resize", "Zoom", "ShiftIntensity", "NormalizeIntensity", "ThresholdIntensity",
+                       "MedianSmooth", "GaussianSmooth", "SpatialPad", "BorderPad", "SpatialCrop", "CenterSpatialCrop"]
+# intensity transformations, meaningless on a label mask: the original mask is saved along with their output
+MASK_INVARIANT_TRANSFORM = ["ScaleIntensity", "RandScaleIntensityd", "AdjustContrast", "RandAdjustContrastd", "RandGaussianNoised", "ShiftIntensity",
+                            "RandShiftIntensityd", "NormalizeIntensity", "ThresholdIntensity", "MedianSmooth", "GaussianSmooth", "RandGaussianSmoothd"]
 class ImageAugmenterTransformationParser():
     def __init__(self, ui):
        self.ui = ui
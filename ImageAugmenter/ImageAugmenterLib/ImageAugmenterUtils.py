@@ -1,36 +1,38 @@
 import os
 import re
 import SimpleITK as sitk
-import sitkUtils
-import threading
-import slicer
 
 FLAT = "flat"  # .../path/ImgID.extension, .../path/ImgID_label.extension
 HIERARCHICAL = "hierarchical" # .../path/CaseID/img.extension, # .../path/CaseID/mask.extension
 
 def collectImagesAndMasksList(imagesInputPath, imgPrefix, maskPrefix):
     imgs, masks = [], []
-    for dir in os.listdir(imagesInputPath):
-        if (os.path.isdir(f"{imagesInputPath}/{dir}")):
-            for content in os.listdir(f"{imagesInputPath}/{dir}"):
-                # if the path is a new directory ignore it
-                if (not os.path.isdir(f"{imagesInputPath}/{dir}/{content}")):
-                    if (imgPrefix in content and not content.startswith(".")):
-                        imgs.append(f"{imagesInputPath}/{dir}/{content}")
-                    elif (maskPrefix != None
-                          and maskPrefix != ""
-                          and maskPrefix in f"{imagesInputPath}/{dir}/{content}"
-                          and not content.startswith(".")):
-                        masks.append(f"{imagesInputPath}/{dir}/{content}")
-        else:
-            content = dir
-            if (imgPrefix in content and not content.startswith(".")):
-                imgs.append(f"{imagesInputPath}/{content}")
-            elif (maskPrefix != None
-                  and maskPrefix != ""
-                  and maskPrefix in f"{imagesInputPath}/{content}"
-                  and not content.startswith(".")):
-                masks.append(f"{imagesInputPath}/{content}")
+    # os.scandir returns the file type along with the names, avoiding a stat call per entry
+    with os.scandir(imagesInputPath) as entries:
+        for entry in entries:
+            dir = entry.name
+            if (entry.is_dir()):
+                with os.scandir(f"{imagesInputPath}/{dir}") as dirEntries:
+                    for dirEntry in dirEntries:
+                        content = dirEntry.name
+                        # if the path is a new directory ignore it
+                        if (not dirEntry.is_dir()):
+                            if (imgPrefix in content and not content.startswith(".")):
+                                imgs.append(f"{imagesInputPath}/{dir}/{content}")
+                            elif (maskPrefix != None
+                                  and maskPrefix != ""
+                                  and maskPrefix in f"{imagesInputPath}/{dir}/{content}"
+                                  and not content.startswith(".")):
+                                masks.append(f"{imagesInputPath}/{dir}/{content}")
+            else:
+                content = dir
+                if (imgPrefix in content and not content.startswith(".")):
+                    imgs.append(f"{imagesInputPath}/{content}")
+                elif (maskPrefix != None
+                      and maskPrefix != ""
+                      and maskPrefix in f"{imagesInputPath}/{content}"
+                      and not content.startswith(".")):
+                    masks.append(f"{imagesInputPath}/{content}")
     return imgs, masks
 
 
@@ -62,41 +64,92 @@ def sanitizeTransformName(transform) -> str:
     return re.sub(pattern, "", str(transform.__class__).split(".")[-1])
 
 
-def getOriginalCase(fullImgPath, filesStructure):
+def getImageHeader(image):
     """
-    This function returns the original image and extracts the specific patient/case name/ID.
-    The extracted name/ID will be used as the title of the folder that will contain the augmented images.
+    This function extracts the information of an image (size, origin, spacing, direction)
+    from a sitk.Image or from a sitk.ImageFileReader on which ReadImageInformation has been called.
+    Unlike the SimpleITK objects, the header can be sent back by the DataLoader workers.
+
+    Returns:
+        header (dict)
+    """
+    return {
+        "size": image.GetSize(),
+        "origin": image.GetOrigin(),
+        "spacing": image.GetSpacing(),
+        "direction": image.GetDirection(),
+    }
+
+
+def readImageHeader(path):
+    """
+    This function reads only the information of an image, without decoding the voxels.
+
+    Returns:
+        header (dict), see getImageHeader
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+
+    return getImageHeader(reader)
+
+
+def copyImageInformation(img, header):
+    """
+    Same as sitk.Image.CopyInformation, but starting from a header returned by readImageHeader.
+    The information is copied only for 3D images, as the original CopyInformation(...) when GetDepth() > 0,
+    and like CopyInformation it raises a RuntimeError when the sizes of the two images differ.
     """
-    caseName = fullImgPath.split(
-        '/')[-2] if (filesStructure == HIERARCHICAL) else fullImgPath.split('/')[-1]
+    if (len(header["size"]) > 2 and header["size"][2] > 0):
+        if img.GetSize() != tuple(header["size"]):
+            raise RuntimeError(f"Image size {img.GetSize()} does not match the size {tuple(header['size'])} of the original image")
+        img.SetOrigin(header["origin"])
+        img.SetSpacing(header["spacing"])
+        img.SetDirection(header["direction"])
+
 
-    originalCaseImg = sitk.ReadImage(fullImgPath)
+def getCaseName(fullImgPath, filesStructure):
+    """
+    This function extracts the specific patient/case name/ID.
+    The extracted name/ID will be used as the title of the folder that will contain the augmented images.
+    """
+    return fullImgPath.split('/')[-2] if (filesStructure == HIERARCHICAL) else fullImgPath.split('/')[-1]
 
-    return caseName, originalCaseImg
 
-def save(img, path, filename, originalCase, extension, copyInfo=True):
+def save(img, path, filename, originalCase, extension, copyInfo=True, executor=None):
+    """
+    The conversion to a SimpleITK image happens right away, so img can be reused as soon as the function returns.
+    The write is submitted to the executor, if given, and the corresponding future is returned.
+    """
     img = sitk.GetImageFromArray(img)
 
-    if (copyInfo and originalCase.GetDepth() > 0):
-        img.CopyInformation(originalCase)
+    if (copyInfo):
+        copyImageInformation(img, originalCase)
+
+    if (executor is not None):
+        return executor.submit(sitk.WriteImage, img, f"{path}/{filename}.{extension}")
 
-    saveThread = threading.Thread(target=sitk.WriteImage, args=(
-        img, f"{path}/{filename}.{extension}"))
-    saveThread.start()
+    sitk.WriteImage(img, f"{path}/{filename}.{extension}")
+    return None
 
 
 def showPreview(img, originalCaseImg, originalCaseMask=None, mask=None, imgNodeName="imgNode", maskNodeName="maskNode", copyInfo=True):
+    # imported here, this module is also imported by the DataLoader workers where Slicer is not running
+    import sitkUtils
+    import slicer
+
     sitkAugmentedImg = sitk.GetImageFromArray(img.cpu())
-    if (copyInfo and originalCaseImg.GetDepth() > 0):
-        sitkAugmentedImg.CopyInformation(originalCaseImg)
+    if (copyInfo):
+        copyImageInformation(sitkAugmentedImg, originalCaseImg)
 
     outputImgNode = sitkUtils.PushVolumeToSlicer(
         sitkAugmentedImg, name=imgNodeName, className="vtkMRMLScalarVolumeNode")
 
-    if (mask != None):
+    if (mask is not None):
         sitkAugmentedMask = sitk.GetImageFromArray(mask.cpu())
-        if (copyInfo and originalCaseMask.GetDepth() > 0):
-            sitkAugmentedMask.CopyInformation(originalCaseMask)
+        if (copyInfo):
+            copyImageInformation(sitkAugmentedMask, originalCaseMask)
 
         outputMaskNode = sitkUtils.PushVolumeToSlicer(
             sitkAugmentedMask, name=maskNodeName, className="vtkMRMLScalarVolumeNode")
@@ -109,11 +162,15 @@ def showPreview(img, originalCaseImg, originalCaseMask=None, mask=None, imgNodeN
 
 
 def clearScene():
+    import slicer
+
     scene = slicer.mrmlScene
     scene.Clear()
 
 
 def resetViews():
+    import slicer
+
     slicer.app.layoutManager().resetThreeDViews()
     slicer.util.resetSliceViews()
 